@@ -1,47 +1,156 @@
 from datetime import datetime, timedelta
 from typing import Optional
-from jose import JWTError, jwt
+import jwt
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from cachetools import TTLCache
 import hashlib
+import hmac
+import os
+import threading
+import time
 
-from . import crud, schemas
+try:
+    # Нужен только для проверки старых bcrypt-хэшей ($2b$), новые пишутся в Argon2
+    import bcrypt
+except ImportError:
+    bcrypt = None
+
+from . import schemas
 from .database import get_db
 
 # Настройки
 SECRET_KEY = "your-secret-key-change-in-production"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Ключ в байтах готовим один раз, а не на каждый encode/decode
+KEY_BYTES = SECRET_KEY.encode()
+# Границы длины для быстрой отбраковки заведомо некорректных токенов
+MIN_TOKEN_LENGTH = 20
+MAX_TOKEN_LENGTH = 2048
 
 security = HTTPBearer()
 
-def verify_password(plain_password, hashed_password):
-    # Временное решение с SHA256
-    return hashlib.sha256(plain_password.encode()).hexdigest() == hashed_password
+# Кэш проверенных токенов (ключ - хэш токена, сам токен не храним) и кэш пользователей.
+# Подпись токена не меняется, а exp перепроверяется при каждом попадании,
+# поэтому проверенный токен держим весь срок его жизни.
+# TTL пользователей короткий, задержка блокировки ограничена минутой.
+TOKEN_CACHE_TTL = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+USER_CACHE_TTL = min(60, ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+_token_cache = TTLCache(maxsize=10_000, ttl=TOKEN_CACHE_TTL)
+_user_cache = TTLCache(maxsize=5_000, ttl=USER_CACHE_TTL)
+_cache_lock = threading.RLock()
+
+# Argon2id, по умолчанию минимальный профиль OWASP (19 МиБ, 2 прохода) -
+# десятки миллисекунд на хэш; стоимость можно подстроить под бюджет
+# задержки через переменные окружения
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "2"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "19456"))
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", "1"))
+_ph = PasswordHasher(
+    time_cost=ARGON2_TIME_COST,
+    memory_cost=ARGON2_MEMORY_COST,
+    parallelism=ARGON2_PARALLELISM
+)
+
+# Argon2 не обрезает длинные пароли (в отличие от 72 байт bcrypt), но длину
+# все равно ограничиваем в байтах при регистрации, чтобы не хэшировать произвольно
+# большие строки. При входе не проверяем: старые аккаунты могли завести пароль длиннее
+MAX_PASSWORD_BYTES = 256
+
+def password_too_long(password: str) -> bool:
+    return len(password.encode("utf-8")) > MAX_PASSWORD_BYTES
+
+def _is_legacy_hash(hashed_password: str) -> bool:
+    """Старые хэши - это голый SHA256 в hex (64 символа)"""
+    return len(hashed_password) == 64 and all(c in "0123456789abcdef" for c in hashed_password)
+
+def _is_bcrypt_hash(hashed_password: str) -> bool:
+    return hashed_password.startswith(("$2a$", "$2b$", "$2y$"))
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    if not hashed_password:
+        return False
+    if _is_legacy_hash(hashed_password):
+        legacy = hashlib.sha256(plain_password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, hashed_password)
+    if _is_bcrypt_hash(hashed_password):
+        if bcrypt is None:
+            return False
+        try:
+            return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+        except ValueError:
+            return False
+    try:
+        return _ph.verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHashError):
+        return False
 
-def get_password_hash(password):
-    # Временное решение с SHA256
-    return hashlib.sha256(password.encode()).hexdigest()
+def password_needs_rehash(hashed_password: str) -> bool:
+    if _is_legacy_hash(hashed_password) or _is_bcrypt_hash(hashed_password):
+        return True
+    return _ph.check_needs_rehash(hashed_password)
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+def get_password_hash(password: str) -> str:
+    return _ph.hash(password)
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, KEY_BYTES, algorithm=ALGORITHM)
     return encoded_jwt
 
+def decode_access_token(token: str) -> dict:
+    """Проверяет подпись и срок действия, при ошибке бросает jwt.PyJWTError"""
+    return jwt.decode(token, KEY_BYTES, algorithms=[ALGORITHM], options={"require": ["exp"]})
+
 def authenticate_user(db: Session, email: str, password: str):
-    user = crud.get_user_by_email(db, email)
-    if not user:
+    from .crud import get_user_auth_fields, get_user
+
+    # Полную строку пользователя загружаем только после проверки пароля
+    row = get_user_auth_fields(db, email)
+    if not row:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not verify_password(password, row.hashed_password):
         return False
+    user = get_user(db, row.id)
+    # Перехэшируем старые SHA256, bcrypt и устаревшие параметры Argon2 при успешном входе
+    if password_needs_rehash(row.hashed_password):
+        user.hashed_password = get_password_hash(password)
+        db.commit()
     return user
 
+def get_token_subject(token: str) -> Optional[str]:
+    """Email из токена или None; повторные проверки того же токена берутся из кэша"""
+    # Мусор от сканеров отсекаем по структуре JWT, не доходя до хэша и HMAC
+    if token.count(".") != 2 or not (MIN_TOKEN_LENGTH <= len(token) <= MAX_TOKEN_LENGTH):
+        return None
+    key = hashlib.sha256(token.encode()).digest()[:16]
+    with _cache_lock:
+        cached = _token_cache.get(key)
+    # В кэше только (exp, sub), извлеченные при единственном декодировании;
+    # exp перепроверяем при каждом попадании
+    if cached is not None and cached[0] > time.time():
+        return cached[1]
+
+    try:
+        payload = decode_access_token(token)
+    except jwt.PyJWTError:
+        return None
+    email = payload.get("sub")
+    if email is None:
+        return None
+    with _cache_lock:
+        _token_cache[key] = (payload["exp"], email)
+    return email
+
 def get_current_user(
         credentials: HTTPAuthorizationCredentials = Depends(security),
         db: Session = Depends(get_db)
@@ -51,19 +160,32 @@ def get_current_user(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-    except JWTError:
+    email = get_token_subject(credentials.credentials)
+    if email is None:
         raise credentials_exception
 
-    user = crud.get_user_by_email(db, email=email)
+    user = _get_cached_user(db, email)
     if user is None:
         raise credentials_exception
     return user
 
+def _get_cached_user(db: Session, email: str):
+    """Пользователь по email без запроса в БД, если он есть в кэше"""
+    with _cache_lock:
+        cached = _user_cache.get(email)
+    if cached is None:
+        from .crud import get_user_by_email
+
+        user = get_user_by_email(db, email=email)
+        if user is None:
+            return None
+        # В кэше лежит отсоединенный снимок, каждый запрос получает свою копию в сессии
+        db.expunge(user)
+        with _cache_lock:
+            _user_cache[email] = user
+        cached = user
+    return db.merge(cached, load=False)
+
 def get_current_active_user(current_user: schemas.User = Depends(get_current_user)):
     if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
@@ -75,7 +197,11 @@ __all__ = [
     'ALGORITHM',
     'verify_password',
     'get_password_hash',
+    'password_needs_rehash',
+    'password_too_long',
     'create_access_token',
+    'decode_access_token',
+    'get_token_subject',
     'authenticate_user',
     'get_current_user',
     'get_current_active_user'
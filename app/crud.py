@@ -1,10 +1,36 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc, select
-from typing import List, Optional
+from sqlalchemy.orm import Session, raiseload, selectinload, joinedload, aliased
+from sqlalchemy import func, desc, select, or_, case, delete, insert, update, text
+from typing import Dict, List, Optional
+from cachetools import TTLCache, cached
 import json
+import threading
 
 from . import models, schemas
 
+# Кэш статистики пользователей на несколько секунд, сбрасывается при записи
+_stats_cache = TTLCache(maxsize=5000, ttl=10)
+_stats_lock = threading.Lock()
+
+
+# Топ таблицы лидеров и общие счетчики. В своем воркере кэш сбрасывается при записи,
+# TTL ограничивает устаревание в остальных воркерах
+LEADERBOARD_CACHE_TTL = 30
+_leaderboard_cache = TTLCache(maxsize=8, ttl=LEADERBOARD_CACHE_TTL)
+_leaderboard_lock = threading.Lock()
+
+
+def invalidate_leaderboard():
+    with _leaderboard_lock:
+        _leaderboard_cache.clear()
+
+
+def invalidate_user_stats(user_id: Optional[int] = None):
+    with _stats_lock:
+        if user_id is None:
+            _stats_cache.clear()
+        else:
+            _stats_cache.pop(user_id, None)
+
 
 # User CRUD operations
 def get_user(db: Session, user_id: int):
@@ -15,10 +41,28 @@ def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
 
 
+def get_user_auth_fields(db: Session, email: str):
+    """Только поля, нужные для проверки пароля при входе"""
+    return db.query(
+        models.User.id,
+        models.User.hashed_password
+    ).filter(models.User.email == email).first()
+
+
 def get_user_by_phone(db: Session, phone: str):
     return db.query(models.User).filter(models.User.phone == phone).first()
 
 
+def get_user_email_phone_conflict(db: Session, email: str, phone: str):
+    """Первая строка (email, phone), занимающая email или телефон, за один запрос; иначе None"""
+    return db.query(models.User.email, models.User.phone).filter(
+        or_(models.User.email == email, models.User.phone == phone)
+    ).order_by(
+        # Совпадение по email важнее: о нем сообщаем в первую очередь
+        case((models.User.email == email, 0), else_=1)
+    ).first()
+
+
 def get_user_by_telegram(db: Session, telegram_id: str):
     return db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
 
@@ -41,8 +85,12 @@ def create_user(db: Session, user: schemas.UserCreate):
         hashed_password=hashed_password
     )
     db.add(db_user)
+    # Новый пользователь входит в таблицу лидеров с нулем баллов - добавляем одну его строку
+    db.flush()
+    upsert_leaderboard_entry(db, db_user)
     db.commit()
-    db.refresh(db_user)
+    # id уже проставлен при flush, остальные поля не истекли после commit
+    invalidate_leaderboard()
     return db_user
 
 
@@ -51,8 +99,10 @@ def update_user(db: Session, user_id: int, user_update: schemas.UserBase):
     if db_user:
         for field, value in user_update.dict().items():
             setattr(db_user, field, value)
+        upsert_leaderboard_entry(db, db_user)
         db.commit()
         db.refresh(db_user)
+        invalidate_leaderboard()
     return db_user
 
 
@@ -62,12 +112,28 @@ def get_game(db: Session, game_id: int):
 
 
 def get_games(db: Session, skip: int = 0, limit: int = 100, active_only: bool = True):
-    query = db.query(models.Game)
+    # Вопросы всех игр одним IN-запросом, остальные связи не грузим -
+    # случайная ленивая загрузка упадет сразу
+    query = db.query(models.Game).options(
+        selectinload(models.Game.questions),
+        raiseload('*')
+    )
     if active_only:
         query = query.filter(models.Game.is_active == True)
     return query.offset(skip).limit(limit).all()
 
 
+def get_game_cards(db: Session, limit: int = 100):
+    """Активные игры для списка на странице: только нужные колонки, без ORM-объектов"""
+    return db.query(
+        models.Game.id,
+        models.Game.title,
+        models.Game.description,
+        models.Game.game_type,
+        models.Game.points_reward
+    ).filter(models.Game.is_active == True).order_by(models.Game.id).limit(limit).all()
+
+
 def create_game(db: Session, game: schemas.GameCreate, user_id: int):
     # Умножаем базовые баллы награды на 5
     points_reward = game.points_reward * 5
@@ -83,18 +149,21 @@ def create_game(db: Session, game: schemas.GameCreate, user_id: int):
     db.commit()
     db.refresh(db_game)
 
-    # Create questions for the game
-    for i, question_data in enumerate(game.questions):
-        db_question = models.GameQuestion(
-            game_id=db_game.id,
-            question_text=question_data.question_text,
-            question_type=question_data.question_type,
-            options=json.dumps(question_data.options) if question_data.options else None,
-            correct_answer=question_data.correct_answer,
-            explanation=question_data.explanation,
-            order_index=i
-        )
-        db.add(db_question)
+    # Create questions for the game одним пакетным INSERT
+    rows = [
+        {
+            "game_id": db_game.id,
+            "question_text": question_data.question_text,
+            "question_type": question_data.question_type,
+            "options": json.dumps(question_data.options) if question_data.options else None,
+            "correct_answer": question_data.correct_answer,
+            "explanation": question_data.explanation,
+            "order_index": i
+        }
+        for i, question_data in enumerate(game.questions)
+    ]
+    if rows:
+        db.bulk_insert_mappings(models.GameQuestion, rows)
 
     db.commit()
     db.refresh(db_game)
@@ -128,86 +197,167 @@ def create_game_result(db: Session, user_id: int, game_id: int, score: int, tota
     return db_result
 
 
-def get_user_total_points(db: Session, user_id: int):
-    result = db.query(func.sum(models.GameResult.total_points)).filter(
-        models.GameResult.user_id == user_id
+def get_user_total_points(db: Session, user_id: int) -> int:
+    # Баллы денормализованы в users.points_count. Пишут его update_user_points,
+    # update_user_points_and_games и разовый перенос backfill_user_points при инициализации БД;
+    # новые места записи тоже должны обновлять leaderboard_cache (upsert_leaderboard_entry)
+    result = db.query(models.User.points_count).filter(
+        models.User.id == user_id
     ).scalar()
     return result or 0
 
 
-def get_user_games_played(db: Session, user_id: int):
+def backfill_user_points(db: Session):
+    """Переносит суммы из game_results в счетчики пользователей, у которых они еще не заполнены"""
+    points = select(
+        func.coalesce(func.sum(models.GameResult.total_points), 0)
+    ).where(models.GameResult.user_id == models.User.id).scalar_subquery()
+    games = select(
+        func.count(models.GameResult.id)
+    ).where(models.GameResult.user_id == models.User.id).scalar_subquery()
+    has_results = select(models.GameResult.id).where(
+        models.GameResult.user_id == models.User.id
+    ).exists()
+
+    # /api/game/complete начисляет баллы без строк в game_results,
+    # поэтому уже заполненные счетчики не трогаем
+    db.execute(
+        update(models.User)
+        .where(func.coalesce(models.User.points_count, 0) == 0, has_results)
+        .values(points_count=points, games_played_count=games)
+        .execution_options(synchronize_session=False)
+    )
+    db.commit()
+
+
+def get_user_games_played(db: Session, user_id: int) -> int:
     return db.query(models.GameResult).filter(
         models.GameResult.user_id == user_id
     ).count()
 
 
 # Game submission and scoring
-def submit_game_answers(db: Session, game_id: int, user_id: int, answers: dict):
-    game = get_game(db, game_id)
+def submit_game_answers(db: Session, game_id: int, user_id: int, answers: Dict[str, str]):
+    # Для подсчета нужны только баллы игры, вопросы не загружаем
+    game = db.query(models.Game.points_reward).filter(models.Game.id == game_id).first()
     if not game:
         return None
 
-    questions = get_game_questions(db, game_id)
-    if not questions:
+    # Только id и правильные ответы вопросов этой игры, без объектов GameQuestion.
+    # Ключи ответов сравниваем как строки str(question.id): чужие и нечисловые
+    # ключи просто не совпадут, без разбора через int()
+    correct = {
+        str(question_id): correct_answer
+        for question_id, correct_answer in db.query(
+            models.GameQuestion.id,
+            models.GameQuestion.correct_answer
+        ).filter(models.GameQuestion.game_id == game_id)
+    }
+    total_questions = len(correct)
+    if not total_questions:
         return None
+    correct_answers = sum(
+        1 for question_id, correct_answer in correct.items()
+        if correct_answer and answers.get(question_id) == correct_answer
+    )
 
     # Check if user already played this game
     existing_result = get_user_game_results(db, user_id, game_id)
     if existing_result:
         return existing_result
 
-    # Calculate score
-    correct_answers = 0
-    for question in questions:
-        user_answer = answers.get(str(question.id))
-        if user_answer and user_answer == question.correct_answer:
-            correct_answers += 1
-
-    score_percentage = (correct_answers / len(questions)) * 100
+    score_percentage = (correct_answers / total_questions) * 100
     # Умножаем набранные баллы на 5
     points_earned = int((score_percentage / 100) * game.points_reward)
 
     # Save result
-    return create_game_result(db, user_id, game_id, score_percentage, points_earned)
+    result = create_game_result(db, user_id, game_id, score_percentage, points_earned)
+    update_user_points_and_games(db, user_id, points_earned)
+    return result
 
 
 # Leaderboard operations
-def get_leaderboard(db: Session, limit: int = 50):
-    # Подзапрос для подсчета очков каждого пользователя
-    points_subquery = (
-        select(
-            models.GameResult.user_id,
-            func.sum(models.GameResult.total_points).label('total_points'),
-            func.count(models.GameResult.id).label('games_played')
+def _leaderboard_select():
+    # Баллы и число игр берутся из денормализованных счетчиков users
+    return select(
+        models.User.id.label('user_id'),
+        models.User.full_name,
+        func.coalesce(models.User.points_count, 0).label('total_points'),
+        func.coalesce(models.User.games_played_count, 0).label('games_played')
+    )
+
+
+def refresh_leaderboard(db: Session):
+    """Полная пересборка leaderboard_cache одним INSERT ... SELECT - только при старте;
+    при записи обновляется одна строка через upsert_leaderboard_entry"""
+    db.execute(delete(models.LeaderboardCache))
+    db.execute(
+        insert(models.LeaderboardCache).from_select(
+            ['user_id', 'full_name', 'total_points', 'games_played'],
+            _leaderboard_select()
         )
-        .group_by(models.GameResult.user_id)
-        .subquery()
     )
+    db.commit()
+    invalidate_user_stats()
+    invalidate_leaderboard()
+
+
+def upsert_leaderboard_entry(db: Session, user: models.User):
+    """Обновляет строку пользователя в leaderboard_cache в текущей транзакции, без commit"""
+    values = {
+        'full_name': user.full_name,
+        'total_points': user.points_count or 0,
+        'games_played': user.games_played_count or 0
+    }
+    result = db.execute(
+        update(models.LeaderboardCache)
+        .where(models.LeaderboardCache.user_id == user.id)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        db.execute(insert(models.LeaderboardCache).values(user_id=user.id, **values))
 
-    # Основной запрос с ранжированием
-    leaderboard_data = db.query(
-        models.User.id,
-        models.User.full_name,
-        func.coalesce(points_subquery.c.total_points, 0).label('total_points'),
-        func.coalesce(points_subquery.c.games_played, 0).label('games_played')
-    ).outerjoin(
-        points_subquery, models.User.id == points_subquery.c.user_id
-    ).order_by(
-        desc('total_points')
-    ).limit(limit).all()
 
-    # Добавляем ранги
-    leaderboard = []
-    for rank, (user_id, full_name, total_points, games_played) in enumerate(leaderboard_data, 1):
-        leaderboard.append({
-            'rank': rank,
-            'user_id': user_id,
-            'full_name': full_name,
-            'total_points': total_points or 0,
-            'games_played': games_played or 0
-        })
+def leaderboard_changed():
+    """Сбрасывает кэши после изменения баллов: ранги могли поменяться у всех пользователей"""
+    invalidate_user_stats()
+    invalidate_leaderboard()
 
-    return leaderboard
+
+@cached(_leaderboard_cache, key=lambda db, limit=50: ('top', limit), lock=_leaderboard_lock)
+def get_leaderboard(db: Session, limit: int = 50):
+    # Ранг считаем только по первым limit строкам (по индексу на total_points):
+    # все, у кого баллов больше, тоже в них попадают, так что ранг совпадает с общим
+    cache = models.LeaderboardCache
+    top = select(
+        cache.user_id,
+        cache.full_name,
+        cache.total_points,
+        cache.games_played
+    ).order_by(desc(cache.total_points), cache.user_id).limit(limit).subquery()
+    return db.execute(
+        select(
+            func.rank().over(order_by=desc(top.c.total_points)).label('rank'),
+            top.c.user_id,
+            top.c.full_name,
+            top.c.total_points,
+            top.c.games_played
+        ).order_by(desc(top.c.total_points), top.c.user_id)
+    ).all()
+
+
+@cached(_leaderboard_cache, key=lambda db: ('aggregates',), lock=_leaderboard_lock)
+def get_leaderboard_aggregates(db: Session):
+    """Число пользователей, сыгранных игр и сумма баллов одним запросом"""
+    cache = models.LeaderboardCache
+    return db.execute(
+        select(
+            func.count(cache.user_id).label('total_users'),
+            func.coalesce(func.sum(cache.games_played), 0).label('total_games_played'),
+            func.coalesce(func.sum(cache.total_points), 0).label('total_points')
+        )
+    ).one()
 
 
 # Reward CRUD operations
@@ -216,7 +366,7 @@ def get_reward(db: Session, reward_id: int):
 
 
 def get_rewards(db: Session, skip: int = 0, limit: int = 100, available_only: bool = True):
-    query = db.query(models.Reward)
+    query = db.query(models.Reward).options(raiseload('*'))
     if available_only:
         query = query.filter(
             models.Reward.is_available == True,
@@ -225,6 +375,21 @@ def get_rewards(db: Session, skip: int = 0, limit: int = 100, available_only: bo
     return query.offset(skip).limit(limit).all()
 
 
+def get_reward_cards(db: Session, limit: int = 100):
+    """Доступные награды для списка на странице: только нужные колонки, без ORM-объектов"""
+    return db.query(
+        models.Reward.id,
+        models.Reward.name,
+        models.Reward.description,
+        models.Reward.points_required,
+        models.Reward.image_url,
+        models.Reward.stock_quantity
+    ).filter(
+        models.Reward.is_available == True,
+        models.Reward.stock_quantity > 0
+    ).order_by(models.Reward.points_required, models.Reward.id).limit(limit).all()
+
+
 def create_reward(db: Session, reward: schemas.RewardCreate):
     db_reward = models.Reward(
         name=reward.name,
@@ -252,27 +417,40 @@ def update_reward_stock(db: Session, reward_id: int, new_stock: int):
 
 # Reward Claim operations
 def create_reward_claim(db: Session, user_id: int, reward_id: int):
+    # Списываем остаток одним условным UPDATE, чтобы параллельные заявки
+    # не могли забрать последнюю единицу дважды
+    result = db.execute(
+        update(models.Reward)
+        .where(
+            models.Reward.id == reward_id,
+            models.Reward.stock_quantity > 0,
+            models.Reward.is_available == True
+        )
+        .values(
+            stock_quantity=models.Reward.stock_quantity - 1,
+            is_available=case((models.Reward.stock_quantity > 1, True), else_=False)
+        )
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        db.rollback()
+        return None
+
     db_claim = models.RewardClaim(
         user_id=user_id,
         reward_id=reward_id,
         status="pending"
     )
     db.add(db_claim)
-
-    # Update reward stock
-    reward = get_reward(db, reward_id)
-    if reward and reward.stock_quantity > 0:
-        reward.stock_quantity -= 1
-        if reward.stock_quantity <= 0:
-            reward.is_available = False
-
     db.commit()
     db.refresh(db_claim)
     return db_claim
 
 
 def get_user_reward_claims(db: Session, user_id: int):
-    return db.query(models.RewardClaim).filter(
+    return db.query(models.RewardClaim).options(
+        joinedload(models.RewardClaim.reward)
+    ).filter(
         models.RewardClaim.user_id == user_id
     ).all()
 
@@ -292,7 +470,7 @@ def get_internship(db: Session, internship_id: int):
 
 
 def get_internships(db: Session, skip: int = 0, limit: int = 100, active_only: bool = True):
-    query = db.query(models.Internship)
+    query = db.query(models.Internship).options(raiseload('*'))
     if active_only:
         query = query.filter(models.Internship.is_active == True)
     return query.offset(skip).limit(limit).all()
@@ -313,26 +491,57 @@ def create_internship(db: Session, internship: schemas.InternshipCreate):
 
 
 # Admin operations
+# Для админских счетчиков точность до минуты не важна
+_row_count_cache = TTLCache(maxsize=32, ttl=60)
+_row_count_lock = threading.Lock()
+
+
+def approx_row_count(db: Session, table_name: str) -> int:
+    """Примерное число строк: reltuples на Postgres, COUNT(*) на остальных СУБД"""
+    with _row_count_lock:
+        count = _row_count_cache.get(table_name)
+    if count is not None:
+        return count
+
+    if db.get_bind().dialect.name == "postgresql":
+        count = db.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE relname = :name"),
+            {"name": table_name}
+        ).scalar()
+    else:
+        table = models.Base.metadata.tables[table_name]
+        count = db.execute(select(func.count()).select_from(table)).scalar()
+    count = max(count or 0, 0)
+
+    with _row_count_lock:
+        _row_count_cache[table_name] = count
+    return count
+
+
 def get_all_users_count(db: Session):
-    return db.query(models.User).count()
+    return approx_row_count(db, models.User.__tablename__)
 
 
 def get_all_games_count(db: Session):
-    return db.query(models.Game).count()
+    return approx_row_count(db, models.Game.__tablename__)
 
 
 def get_all_rewards_count(db: Session):
-    return db.query(models.Reward).count()
+    return approx_row_count(db, models.Reward.__tablename__)
 
 
 def get_pending_reward_claims(db: Session):
-    return db.query(models.RewardClaim).filter(
+    # Заявки разбирают вместе с пользователем и наградой - грузим их тем же запросом
+    return db.query(models.RewardClaim).options(
+        joinedload(models.RewardClaim.user),
+        joinedload(models.RewardClaim.reward)
+    ).filter(
         models.RewardClaim.status == "pending"
     ).all()
 
 
 # Utility functions
-def can_user_claim_reward(db: Session, user_id: int, reward_id: int):
+def can_user_claim_reward(db: Session, user_id: int, reward_id: int) -> bool:
     user_points = get_user_total_points(db, user_id)
     reward = get_reward(db, reward_id)
 
@@ -342,12 +551,19 @@ def can_user_claim_reward(db: Session, user_id: int, reward_id: int):
     return user_points >= reward.points_required
 
 
-def get_user_rank(db: Session, user_id: int):
-    leaderboard = get_leaderboard(db, limit=1000)  # Get large enough list to find user
-    for entry in leaderboard:
-        if entry['user_id'] == user_id:
-            return entry['rank']
-    return None
+def _user_rank_expr():
+    # Ранг = число пользователей с большим количеством баллов + 1 (как RANK()),
+    # считается диапазоном по индексу ix_users_points_desc
+    others = aliased(models.User)
+    return (
+        select(func.count(others.id) + 1)
+        .where(others.points_count > models.User.points_count)
+        .scalar_subquery()
+    )
+
+
+def get_user_rank(db: Session, user_id: int) -> Optional[int]:
+    return db.query(_user_rank_expr()).filter(models.User.id == user_id).scalar()
 
 # Additional utility function to get game results with multiplier info
 def get_user_game_results_with_multiplier(db: Session, user_id: int, game_id: int):
@@ -369,7 +585,7 @@ def get_user_game_results_with_multiplier(db: Session, user_id: int, game_id: in
 
 
 # Function to calculate points with multiplier for display
-def calculate_points_with_multiplier(base_points: int, multiplier: int = 5):
+def calculate_points_with_multiplier(base_points: int, multiplier: int = 5) -> int:
     """
     Рассчитывает баллы с применением множителя
     """
@@ -380,12 +596,14 @@ def update_user_points(db: Session, user_id: int, points_to_add: int):
     user = get_user(db, user_id)
     if user:
         user.points_count += points_to_add
+        upsert_leaderboard_entry(db, user)
         db.commit()
         db.refresh(user)
+        leaderboard_changed()
         return user
     return None
 
-def get_user_points(db: Session, user_id: int):
+def get_user_points(db: Session, user_id: int) -> int:
     user = get_user(db, user_id)
     return user.points_count if user else 0
 
@@ -395,26 +613,46 @@ def update_user_points_and_games(db: Session, user_id: int, points_to_add: int):
     if user:
         user.points_count += points_to_add
         user.games_played_count += 1  # Увеличиваем счетчик игр
+        # Та же транзакция обновляет одну строку таблицы лидеров, без полной пересборки
+        upsert_leaderboard_entry(db, user)
         db.commit()
         db.refresh(user)
+        # Сбрасывает и кэш статистики, и кэш топа
+        leaderboard_changed()
         return user
     return None
 
 def get_user_stats(db: Session, user_id: int):
-    """Получает статистику пользователя"""
-    user = get_user(db, user_id)
-    if not user:
+    """Получает статистику пользователя вместе с рангом одним запросом"""
+    with _stats_lock:
+        stats = _stats_cache.get(user_id)
+    if stats is not None:
+        return stats
+
+    row = db.query(
+        models.User.points_count,
+        models.User.games_played_count,
+        _user_rank_expr().label('rank')
+    ).filter(models.User.id == user_id).first()
+    if not row:
         return None
 
+    points_count = row.points_count or 0
+    games_played_count = row.games_played_count or 0
+
     # Рассчитываем средний балл
     average_score = 0
-    if user.games_played_count > 0:
-        average_score = user.points_count / user.games_played_count
+    if games_played_count > 0:
+        average_score = points_count / games_played_count
 
-    return {
-        'total_points': user.points_count,
-        'games_played': user.games_played_count,
+    stats = {
+        'total_points': points_count,
+        'games_played': games_played_count,
         'average_score': round(average_score, 1),
-        'points_count': user.points_count,
-        'games_played_count': user.games_played_count
-    }
\ No newline at end of file
+        'points_count': points_count,
+        'games_played_count': games_played_count,
+        'rank': row.rank
+    }
+    with _stats_lock:
+        _stats_cache[user_id] = stats
+    return stats
\ No newline at end of file
@@ -1,46 +1,176 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+import hashlib
+import logging
 import os
+from typing import Optional
+
+logger = logging.getLogger(__name__)
 
 # SQLite база данных
 SQLALCHEMY_DATABASE_URL = "sqlite:///./app.db"
+DB_FILE = "./app.db"
+# Отметка о том, что схема текущей версии моделей уже создана
+DB_INIT_SENTINEL = os.getenv("DB_INIT_SENTINEL", "./.db_initialized")
 
 # Создаем движок SQLAlchemy
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False}
+    connect_args={"check_same_thread": False, "timeout": 30},
+    pool_size=20,
+    max_overflow=10,
+    # Файл SQLite локальный, "мертвых" соединений не бывает - пинг перед выдачей лишний
+    pool_pre_ping=False,
+    pool_recycle=1800
 )
 
-# Создаем фабрику сессий
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL, чтобы читатели не блокировали писателя, и кэш страниц побольше"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+# Создаем фабрику сессий; после commit объекты не истекают,
+# чтобы чтение их атрибутов не вызывало повторный SELECT
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
 # Базовый класс для моделей
 Base = declarative_base()
 
+def _create_schema(connection):
+    """Таблицы и индексы моделей на соединении с уже открытой транзакцией"""
+    # Создаем все таблицы
+    Base.metadata.create_all(bind=connection)
+
+    # create_all не добавляет индексы в уже существующие таблицы
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                with connection.begin_nested():
+                    index.create(bind=connection, checkfirst=True)
+            except IntegrityError:
+                # В старой базе могут быть дубли (например, результаты одной игры):
+                # уникальный индекс не создаем, но запуск не прерываем
+                logger.warning(
+                    "⚠️ Индекс %s не создан: в таблице %s есть дубликаты",
+                    index.name, table.name
+                )
+
 def create_database():
     """Создает базу данных и все таблицы, если они не существуют"""
     try:
         # Проверяем существование файла базы данных
-        db_file = "./app.db"
-        db_exists = os.path.exists(db_file)
+        db_exists = os.path.exists(DB_FILE)
 
-        # Создаем все таблицы
-        Base.metadata.create_all(bind=engine)
+        with engine.connect() as connection:
+            # Несколько воркеров стартуют одновременно: BEGIN IMMEDIATE берет блокировку
+            # записи SQLite, остальные ждут ее (timeout) и проверяют схему уже после нас
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            _create_schema(connection)
+            connection.commit()
 
         if not db_exists:
-            print("✅ База данных создана успешно!")
+            logger.info("✅ База данных создана успешно!")
         else:
-            print("✅ База данных подключена!")
+            logger.info("✅ База данных подключена!")
 
-    except Exception as e:
-        print(f"❌ Ошибка при создании базы данных: {e}")
+    except Exception:
+        logger.exception("❌ Ошибка при создании базы данных")
         raise
 
+def _schema_fingerprint() -> str:
+    """Отпечаток таблиц, колонок и индексов моделей: меняется при изменении схемы"""
+    parts = []
+    for table in Base.metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend(column.name for column in table.columns)
+        parts.extend(sorted(index.name for index in table.indexes))
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+def _read_sentinel() -> Optional[str]:
+    try:
+        with open(DB_INIT_SENTINEL) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _migrate_data(db: Session, first_init: bool):
+    """Разовые переносы данных; выполняются под той же блокировкой, что и создание схемы"""
+    from . import crud
+
+    if first_init:
+        # База без отметки создана до счетчиков в users: переносим суммы из game_results.
+        # Повторно не запускаем - /api/game/complete пишет счетчики без строк результатов
+        crud.backfill_user_points(db)
+    # Полная пересборка таблицы лидеров - только при создании или смене схемы;
+    # дальше строки обновляет upsert_leaderboard_entry при каждой записи
+    crud.refresh_leaderboard(db)
+
+def init_database() -> bool:
+    """Создает схему и переносит данные только при INIT_DB=1 или если схема этой версии еще не создавалась"""
+    fingerprint = _schema_fingerprint()
+    force = os.getenv("INIT_DB") == "1"
+
+    def up_to_date() -> bool:
+        return not force and os.path.exists(DB_FILE) and _read_sentinel() == fingerprint
+
+    if up_to_date():
+        logger.info("✅ База данных подключена, схема уже создана")
+        return False
+
+    db_exists = os.path.exists(DB_FILE)
+    try:
+        with engine.connect() as connection:
+            # Воркеры, стартовавшие одновременно, ждут здесь блокировку записи
+            # и повторно проверяют отметку: схему и перенос делает только первый
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            previous = _read_sentinel()
+            if up_to_date():
+                connection.rollback()
+                logger.info("✅ База данных подключена, схема уже создана")
+                return False
+
+            _create_schema(connection)
+            # Сессия присоединяется к открытой транзакции: ее commit не снимает блокировку
+            db = Session(bind=connection)
+            try:
+                _migrate_data(db, first_init=previous is None)
+            finally:
+                db.close()
+
+            # Отметку пишем до commit, пока держим блокировку; при ошибке убираем
+            with open(DB_INIT_SENTINEL, "w") as f:
+                f.write(fingerprint)
+            try:
+                connection.commit()
+            except Exception:
+                os.remove(DB_INIT_SENTINEL)
+                raise
+    except Exception:
+        logger.exception("❌ Ошибка при создании базы данных")
+        raise
+
+    if not db_exists:
+        logger.info("✅ База данных создана успешно!")
+    else:
+        logger.info("✅ База данных подключена!")
+    return True
+
 # Зависимость для получения сессии базы данных
 def get_db():
     db = SessionLocal()
     try:
         yield db
+    except Exception:
+        db.rollback()
+        raise
     finally:
         db.close()
\ No newline at end of file
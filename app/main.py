@@ -1,28 +1,41 @@
-from fastapi import FastAPI, Depends, HTTPException, Request, Form, Cookie
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, Depends, HTTPException, Request, Form, Cookie, Query
+from fastapi.responses import Response, HTMLResponse, RedirectResponse, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-from sqlalchemy import func
+from fastapi.middleware.gzip import GZipMiddleware
 from sqlalchemy.orm import Session
 import os
 from typing import Optional
 import logging
-from jose import jwt
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from functools import lru_cache
+import anyio.to_thread
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
 from app import crud, models, schemas, auth
-from app.database import SessionLocal, engine, create_database
-from app.auth import get_current_user, get_current_active_user, SECRET_KEY, ALGORITHM
+from app.database import SessionLocal, engine, init_database, get_db
+from app.auth import get_current_user, get_current_active_user
 
 # Настройка логирования
-logging.basicConfig(level=logging.INFO)
+# Записи уходят в очередь, в stderr их пишет отдельный поток QueueListener,
+# поэтому логирование не блокирует обработку запроса
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+# force: run.py мог уже настроить вывод для инициализации БД в этом же процессе
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(_log_queue)], force=True)
+logging.getLogger("uvicorn.access").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 app = FastAPI(
     title="X5Tech Student Platform",
     version="1.0.0",
-    description="Платформа для взаимодействия студентов с X5Tech"
+    description="Платформа для взаимодействия студентов с X5Tech",
+    default_response_class=ORJSONResponse
 )
 
+# Сжимаем HTML и JSON; уровень 5 - компромисс между CPU и степенью сжатия
+app.add_middleware(GZipMiddleware, minimum_size=800, compresslevel=5)
+
 # Определяем правильные пути
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # Папка ShortHack
 FRONTEND_DIR = os.path.join(BASE_DIR, "frontend")
@@ -30,57 +43,161 @@ FRONTEND_DIR = os.path.join(BASE_DIR, "frontend")
 # Монтируем статические файлы фронтенда
 app.mount("/static", StaticFiles(directory=os.path.join(FRONTEND_DIR, "static")), name="static")
 
-# Настраиваем шаблоны
-templates = Jinja2Templates(directory=os.path.join(FRONTEND_DIR, "templates"))
+IS_PRODUCTION = os.getenv("ENV") == "production"
+# Размер пула потоков для синхронных обработчиков (по умолчанию в anyio - 40)
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+
+# Настраиваем шаблоны: окружение собираем явно, чтобы задать кэши при создании.
+# В продакшене шаблоны не меняются: не проверяем файлы на каждый рендер
+# и храним скомпилированный байткод между перезапусками
+_jinja_options = {}
+if IS_PRODUCTION:
+    JINJA_CACHE_DIR = os.getenv("JINJA_CACHE_DIR", "/tmp/jinja_cache")
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+    _jinja_options["bytecode_cache"] = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+templates_env = Environment(
+    loader=FileSystemLoader(os.path.join(FRONTEND_DIR, "templates")),
+    autoescape=True,
+    auto_reload=not IS_PRODUCTION,
+    cache_size=400,
+    **_jinja_options
+)
+
+def _get_template(name: str):
+    return templates_env.get_template(name)
+
+if IS_PRODUCTION:
+    # Готовый объект Template без обращения к загрузчику
+    _get_template = lru_cache(maxsize=64)(_get_template)
+
+def render_template(name: str, context: dict) -> HTMLResponse:
+    """Рендерит шаблон в HTMLResponse; в context обязательно передается request"""
+    return HTMLResponse(_get_template(name).render(context))
+
+def stream_template(name: str, context: dict) -> StreamingResponse:
+    """Отдает шаблон по частям по мере рендера, для страниц со списками"""
+    return StreamingResponse(_get_template(name).generate(context), media_type="text/html")
+
+# Публичные страницы, которые анонимным пользователям можно отдавать из кэша
+PUBLIC_CACHEABLE_PATHS = {"/about", "/internships", "/leaderboard"}
+PUBLIC_CACHE_CONTROL = "public, max-age=30, stale-while-revalidate=60"
+# ETag только у страниц без данных из БД: их содержимое меняется лишь вместе с шаблонами.
+# Таблица лидеров у каждого воркера кэшируется отдельно, поэтому для нее - только max-age
+PUBLIC_ETAG_PATHS = {"/about", "/internships"}
+
+def _templates_version() -> str:
+    """Версия шаблонов по времени изменения файлов - одинаковая во всех воркерах"""
+    templates_dir = os.path.join(FRONTEND_DIR, "templates")
+    return format(max(
+        os.stat(os.path.join(templates_dir, name)).st_mtime_ns
+        for name in templates_env.list_templates()
+    ), "x")
+
+TEMPLATES_VERSION = _templates_version()
+
+@app.middleware("http")
+async def public_cache_headers(request: Request, call_next):
+    """Cache-Control для анонимных GET публичных страниц, слабый ETag для статичных"""
+    if (
+        request.method != "GET"
+        or request.url.path not in PUBLIC_CACHEABLE_PATHS
+        or "access_token" in request.cookies
+    ):
+        return await call_next(request)
+
+    # Ответ зависит и от куки, и от сжатия (GZip), Vary перечисляет оба
+    headers = {"Cache-Control": PUBLIC_CACHE_CONTROL, "Vary": "Accept-Encoding, Cookie"}
+    if request.url.path in PUBLIC_ETAG_PATHS:
+        etag = f'W/"{TEMPLATES_VERSION}-{request.url.path.strip("/")}"'
+        headers["ETag"] = etag
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+    response = await call_next(request)
+    if response.status_code == 200:
+        response.headers.update(headers)
+    return response
+
+def _request_cache(request: Request) -> dict:
+    """Словарь для мемоизации запросов к БД в пределах одного HTTP-запроса, создается по требованию"""
+    cache = getattr(request.state, "cache", None)
+    if cache is None:
+        cache = request.state.cache = {}
+    return cache
+
+def cached_user_by_email(request: Request, db: Session, email: str) -> Optional[models.User]:
+    """get_user_by_email с кэшем на время запроса; заодно запоминает баллы пользователя"""
+    cache = _request_cache(request)
+    key = ('email', email)
+    if key not in cache:
+        user = crud.get_user_by_email(db, email=email)
+        cache[key] = user
+        if user is not None:
+            cache[('pts', user.id)] = user.points_count or 0
+    return cache[key]
+
+def cached_points(request: Request, db: Session, user_id: int) -> int:
+    """get_user_total_points с кэшем на время запроса"""
+    cache = _request_cache(request)
+    key = ('pts', user_id)
+    if key not in cache:
+        cache[key] = crud.get_user_total_points(db, user_id)
+    return cache[key]
 
 @app.on_event("startup")
 def startup_event():
     """Создает базу данных при запуске приложения"""
+    _log_listener.start()
     logger.info("🚀 Запуск X5Tech Student Platform...")
-    create_database()
+    # Хэширование паролей и запросы к БД идут в пуле потоков, размер пула под нагрузку на вход
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    # Схему и разовые переносы данных (в том числе пересборку таблицы лидеров) выполняем
+    # только при первом запуске, после изменения моделей или при INIT_DB=1
+    init_database()
+    schemas.rebuild_schemas()
+    # Компилируем все шаблоны заранее, чтобы первый запрос не платил за разбор
+    for name in templates_env.list_templates(extensions=["html"]):
+        _get_template(name)
     logger.info("✅ Платформа готова к работе!")
 
-# Dependency
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+@app.on_event("shutdown")
+def shutdown_event():
+    """Дописывает оставшиеся в очереди логи"""
+    _log_listener.stop()
+
+# Обработчики и зависимости, которые ходят в БД, объявлены через def:
+# синхронный SQLAlchemy выполняется в пуле потоков и не блокирует event loop
+
+def get_email_from_cookie(access_token: Optional[str]) -> Optional[str]:
+    """Email из куки access_token; проверенные токены берутся из кэша auth"""
+    if not access_token:
+        return None
+    # В куке лежит сам токен; префикс "Bearer " остался только у старых кук
+    return auth.get_token_subject(access_token.removeprefix("Bearer ").strip())
 
 # Dependency для получения пользователя из куки
-async def get_current_user_from_cookie(
+def get_current_user_from_cookie(
+        request: Request,
         access_token: Optional[str] = Cookie(None),
         db: Session = Depends(get_db)
 ):
-    if not access_token:
+    email = get_email_from_cookie(access_token)
+    if email is None:
         return None
 
-    try:
-        # Убираем "Bearer " из токена
-        token = access_token.replace("Bearer ", "")
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            return None
-    except Exception:
-        return None
-
-    user = crud.get_user_by_email(db, email=email)
-    return user
+    return cached_user_by_email(request, db, email)
 
 # Главная страница
 @app.get("/", response_class=HTMLResponse)
-async def read_root(
+def read_root(
         request: Request,
-        user: Optional[models.User] = Depends(get_current_user_from_cookie),
-        db: Session = Depends(get_db)
+        user: Optional[models.User] = Depends(get_current_user_from_cookie)
 ):
-    user_points = 0
-    if user:
-        user_points = crud.get_user_total_points(db, user.id)
+    # Баллы уже есть в строке пользователя, загруженной зависимостью
+    user_points = (user.points_count or 0) if user else 0
 
-    return templates.TemplateResponse("index.html", {
+    return render_template("index.html", {
         "request": request,
         "user": user,
         "user_points": user_points
@@ -90,10 +207,9 @@ async def read_root(
 @app.get("/about", response_class=HTMLResponse)
 async def about_company(
         request: Request,
-        user: Optional[models.User] = Depends(get_current_user_from_cookie),
-        db: Session = Depends(get_db)
+        user: Optional[models.User] = Depends(get_current_user_from_cookie)
 ):
-    return templates.TemplateResponse("about.html", {
+    return render_template("about.html", {
         "request": request,
         "user": user
     })
@@ -102,10 +218,9 @@ async def about_company(
 @app.get("/internships", response_class=HTMLResponse)
 async def read_internships(
         request: Request,
-        user: Optional[models.User] = Depends(get_current_user_from_cookie),
-        db: Session = Depends(get_db)
+        user: Optional[models.User] = Depends(get_current_user_from_cookie)
 ):
-    return templates.TemplateResponse("internships.html", {
+    return render_template("internships.html", {
         "request": request,
         "user": user
     })
@@ -115,19 +230,20 @@ async def read_internships(
 @app.get("/register", response_class=HTMLResponse)
 async def register_form(
         request: Request,
-        user: Optional[models.User] = Depends(get_current_user_from_cookie)
+        access_token: Optional[str] = Cookie(None)
 ):
-    if user:
+    # Форма нужна только анонимам: достаточно проверить токен, без сессии БД
+    if get_email_from_cookie(access_token):
         return RedirectResponse(url="/", status_code=303)
 
-    return templates.TemplateResponse("auth/register.html", {
+    return render_template("auth/register.html", {
         "request": request,
-        "user": user
+        "user": None
     })
 
 # Регистрация - POST метод (обрабатывает форму)
 @app.post("/register")
-async def register(
+def register(
         request: Request,
         email: str = Form(...),
         phone: str = Form(...),
@@ -141,22 +257,31 @@ async def register(
     try:
         # Проверяем минимальную длину пароля
         if len(password) < 6:
-            return templates.TemplateResponse("auth/register.html", {
+            return render_template("auth/register.html", {
                 "request": request,
                 "error": "Пароль должен содержать минимум 6 символов",
                 "user": None
             })
 
-        # Проверяем, существует ли пользователь
-        if crud.get_user_by_email(db, email):
-            return templates.TemplateResponse("auth/register.html", {
+        # Ограничение в байтах: кириллица и эмодзи занимают больше одного байта
+        if auth.password_too_long(password):
+            return render_template("auth/register.html", {
+                "request": request,
+                "error": f"Пароль не должен быть длиннее {auth.MAX_PASSWORD_BYTES} байт",
+                "user": None
+            })
+
+        # Проверяем, существует ли пользователь: email и телефон одним запросом
+        conflict = crud.get_user_email_phone_conflict(db, email, phone)
+        if conflict and conflict.email == email:
+            return render_template("auth/register.html", {
                 "request": request,
                 "error": "Пользователь с таким email уже существует",
                 "user": None
             })
 
-        if crud.get_user_by_phone(db, phone):
-            return templates.TemplateResponse("auth/register.html", {
+        if conflict:
+            return render_template("auth/register.html", {
                 "request": request,
                 "error": "Пользователь с таким номером телефона уже существует",
                 "user": None
@@ -173,52 +298,35 @@ async def register(
             interests=interests
         )
 
-        user = crud.create_user(db=db, user=user_data)
+        crud.create_user(db=db, user=user_data)
 
         return RedirectResponse(url="/login", status_code=303)
 
     except Exception as e:
-        print(f"Ошибка при регистрации: {e}")
-        return templates.TemplateResponse("auth/register.html", {
+        logger.exception("Ошибка при регистрации")
+        return render_template("auth/register.html", {
             "request": request,
             "error": f"Произошла ошибка при регистрации: {str(e)}",
             "user": None
         })
 
-def create_user(db: Session, user: schemas.UserCreate):
-    from .auth import get_password_hash
-
-    hashed_password = get_password_hash(user.password)
-    db_user = models.User(
-        email=user.email,
-        phone=user.phone,
-        telegram_id=user.telegram_id,
-        full_name=user.full_name,
-        interests=user.interests,
-        study_direction=user.study_direction,
-        hashed_password=hashed_password
-    )
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    return db_user
-
 # Вход в систему
 @app.get("/login", response_class=HTMLResponse)
 async def login_form(
         request: Request,
-        user: Optional[models.User] = Depends(get_current_user_from_cookie)
+        access_token: Optional[str] = Cookie(None)
 ):
-    if user:
+    # Форма нужна только анонимам: достаточно проверить токен, без сессии БД
+    if get_email_from_cookie(access_token):
         return RedirectResponse(url="/", status_code=303)
 
-    return templates.TemplateResponse("auth/login.html", {
+    return render_template("auth/login.html", {
         "request": request,
-        "user": user
+        "user": None
     })
 
 @app.post("/login")
-async def login(
+def login(
         request: Request,
         email: str = Form(...),
         password: str = Form(...),
@@ -227,7 +335,7 @@ async def login(
     try:
         user = auth.authenticate_user(db, email, password)
         if not user:
-            return templates.TemplateResponse("auth/login.html", {
+            return render_template("auth/login.html", {
                 "request": request,
                 "error": "Неверный email или пароль",
                 "user": None
@@ -237,15 +345,15 @@ async def login(
         response = RedirectResponse(url="/", status_code=303)
         response.set_cookie(
             key="access_token",
-            value=f"Bearer {access_token}",
+            value=access_token,
             httponly=True,
             max_age=1800  # 30 минут
         )
         return response
 
     except Exception as e:
-        print(f"Ошибка при входе: {e}")
-        return templates.TemplateResponse("auth/login.html", {
+        logger.exception("Ошибка при входе")
+        return render_template("auth/login.html", {
             "request": request,
             "error": "Произошла ошибка при входе в систему",
             "user": None
@@ -260,7 +368,7 @@ async def logout():
 
 # Профиль пользователя
 @app.get("/profile", response_class=HTMLResponse)
-async def read_profile(
+def read_profile(
         request: Request,
         user: Optional[models.User] = Depends(get_current_user_from_cookie),
         db: Session = Depends(get_db)
@@ -268,18 +376,11 @@ async def read_profile(
     if not user:
         return RedirectResponse(url="/login", status_code=303)
 
-    # Получаем полную статистику пользователя
+    # Получаем полную статистику пользователя вместе с рангом
     user_stats = crud.get_user_stats(db, user.id)
+    user_rank = user_stats['rank']
 
-    # Получаем ранг пользователя
-    leaderboard = crud.get_leaderboard(db, limit=1000)
-    user_rank = None
-    for entry in leaderboard:
-        if entry['user_id'] == user.id:
-            user_rank = entry['rank']
-            break
-
-    return templates.TemplateResponse("profile.html", {
+    return render_template("profile.html", {
         "request": request,
         "user": user,
         "total_points": user_stats['total_points'],
@@ -290,7 +391,7 @@ async def read_profile(
 
 # Таблица лидеров
 @app.get("/leaderboard", response_class=HTMLResponse)
-async def read_leaderboard(
+def read_leaderboard(
         request: Request,
         user: Optional[models.User] = Depends(get_current_user_from_cookie),
         db: Session = Depends(get_db)
@@ -298,32 +399,23 @@ async def read_leaderboard(
     leaderboard = crud.get_leaderboard(db, limit=25)
 
     # Вычисляем статистику для отображения
-    total_users = db.query(models.User).count()
-    total_games_played = db.query(models.GameResult).count()
-    total_points = db.query(func.sum(models.GameResult.total_points)).scalar() or 0
+    total_users, total_games_played, total_points = crud.get_leaderboard_aggregates(db)
 
     # Средний балл на пользователя
     avg_points_per_user = total_points / total_users if total_users > 0 else 0
 
     # Максимальное количество баллов для прогресс-бара
-    max_points = max([player['total_points'] for player in leaderboard]) if leaderboard else 0
+    max_points = max([player.total_points for player in leaderboard]) if leaderboard else 0
 
     user_stats = {}
     if user:
         user_stats = crud.get_user_stats(db, user.id)
-
-        # Получаем ранг пользователя
-        full_leaderboard = crud.get_leaderboard(db, limit=1000)
-        user_rank = None
-        for entry in full_leaderboard:
-            if entry['user_id'] == user.id:
-                user_rank = entry['rank']
-                break
+        user_rank = user_stats['rank']
     else:
         user_rank = None
         user_stats = {'total_points': 0, 'games_played': 0}
 
-    return templates.TemplateResponse("leaderboard.html", {
+    return stream_template("leaderboard.html", {
         "request": request,
         "user": user,
         "leaderboard": leaderboard,
@@ -338,7 +430,7 @@ async def read_leaderboard(
     })
 # Награды
 @app.get("/rewards", response_class=HTMLResponse)
-async def read_rewards(
+def read_rewards(
         request: Request,
         user: Optional[models.User] = Depends(get_current_user_from_cookie),
         db: Session = Depends(get_db)
@@ -346,9 +438,10 @@ async def read_rewards(
     if not user:
         return RedirectResponse(url="/login", status_code=303)
 
-    rewards = crud.get_rewards(db, available_only=True)
-    user_points = crud.get_user_total_points(db, user.id)
-    return templates.TemplateResponse("rewards.html", {
+    # Строки с колонками вместо ORM-объектов: шаблон только читает поля
+    rewards = crud.get_reward_cards(db)
+    user_points = cached_points(request, db, user.id)
+    return stream_template("rewards.html", {
         "request": request,
         "user": user,
         "rewards": rewards,
@@ -357,7 +450,7 @@ async def read_rewards(
 
 # Игры
 @app.get("/games", response_class=HTMLResponse)
-async def read_games(
+def read_games(
         request: Request,
         user: Optional[models.User] = Depends(get_current_user_from_cookie),
         db: Session = Depends(get_db)
@@ -365,16 +458,15 @@ async def read_games(
     if not user:
         return RedirectResponse(url="/login", status_code=303)
 
-    games = crud.get_games(db, active_only=True)
-    return templates.TemplateResponse("games.html", {
+    games = crud.get_game_cards(db)
+    return stream_template("games.html", {
         "request": request,
         "user": user,
         "games": games
     })
 
-import json
 @app.post("/api/game/complete")
-async def complete_game(
+def complete_game(
         request: Request,
         game_type: str = Form(...),
         score: int = Form(...),
@@ -383,36 +475,51 @@ async def complete_game(
         db: Session = Depends(get_db)
 ):
     """Endpoint для завершения игры и начисления баллов"""
-    if not access_token:
+    email = get_email_from_cookie(access_token)
+    if email is None:
         return {"success": False, "error": "Not authenticated"}
 
     try:
         # Получаем пользователя из токена
-        token = access_token.replace("Bearer ", "")
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-
-        user = crud.get_user_by_email(db, email)
+        user = cached_user_by_email(request, db, email)
         if not user:
             return {"success": False, "error": "User not found"}
 
         # Начисляем баллы и увеличиваем счетчик игр
         updated_user = crud.update_user_points_and_games(db, user.id, total_points)
 
-        # Получаем обновленную статистику
-        user_stats = crud.get_user_stats(db, user.id)
+        # Средний балл считаем по уже обновленной строке, без запроса статистики с рангом
+        games_played = updated_user.games_played_count or 0
+        average_score = round(updated_user.points_count / games_played, 1) if games_played else 0
 
         # Логируем результат игры
-        print(f"User {user.email} completed {game_type} with score {score}, earned {total_points} points. Total games: {updated_user.games_played_count}")
+        logger.info(
+            "User %s completed %s with score %s, earned %s points. Total games: %s",
+            user.email, game_type, score, total_points, updated_user.games_played_count
+        )
 
         return {
             "success": True,
             "new_points": updated_user.points_count,
             "points_earned": total_points,
             "games_played": updated_user.games_played_count,
-            "average_score": user_stats['average_score']
+            "average_score": average_score
         }
 
     except Exception as e:
-        print(f"Error completing game: {e}")
-        return {"success": False, "error": str(e)}
\ No newline at end of file
+        logger.exception("Error completing game")
+        return {"success": False, "error": str(e)}
+
+@app.get("/api/leaderboard")
+def api_leaderboard(
+        limit: int = Query(50, ge=1, le=100),
+        db: Session = Depends(get_db)
+):
+    """Таблица лидеров в JSON: строки из БД сразу отдаются в orjson"""
+    rows = crud.get_leaderboard(db, limit=limit)
+    return ORJSONResponse([dict(row._mapping) for row in rows])
+
+@app.get("/health")
+async def health_check():
+    """Проверка для балансировщика: без БД и шаблонов, ответ сериализует orjson"""
+    return {"status": "ok"}
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from .database import Base
@@ -22,9 +22,14 @@ class User(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     # Связи
+    # Все связи ленивые; жадную загрузку (selectinload/joinedload) задают конкретные запросы
     game_results = relationship("GameResult", back_populates="user")
     rewards = relationship("RewardClaim", back_populates="user")
 
+    __table_args__ = (
+        Index('ix_users_points_desc', points_count.desc(), id),
+    )
+
 class Game(Base):
     __tablename__ = "games"
 
@@ -56,6 +61,10 @@ class GameQuestion(Base):
     # Связи
     game = relationship("Game", back_populates="questions")
 
+    __table_args__ = (
+        Index('ix_gq_game_order', 'game_id', 'order_index'),
+    )
+
 class GameResult(Base):
     __tablename__ = "game_results"
 
@@ -70,6 +79,11 @@ class GameResult(Base):
     user = relationship("User", back_populates="game_results")
     game = relationship("Game", back_populates="results")
 
+    __table_args__ = (
+        Index('ix_gr_user_points', 'user_id', 'total_points'),
+        Index('ix_gr_user_game', 'user_id', 'game_id', unique=True),
+    )
+
 class Reward(Base):
     __tablename__ = "rewards"
 
@@ -82,6 +96,9 @@ class Reward(Base):
     stock_quantity = Column(Integer)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    # Связи
+    claims = relationship("RewardClaim", back_populates="reward")
+
 class RewardClaim(Base):
     __tablename__ = "reward_claims"
 
@@ -93,7 +110,7 @@ class RewardClaim(Base):
 
     # Связи
     user = relationship("User", back_populates="rewards")
-    reward = relationship("Reward")
+    reward = relationship("Reward", back_populates="claims")
 
 class Internship(Base):
     __tablename__ = "internships"
@@ -105,4 +122,19 @@ class Internship(Base):
     duration = Column(String)
     location = Column(String)
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
\ No newline at end of file
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class LeaderboardCache(Base):
+    """Предрасчитанная таблица лидеров: строка пользователя обновляется при изменении баллов,
+    ранг считается при чтении топа"""
+    __tablename__ = "leaderboard_cache"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    full_name = Column(String)
+    total_points = Column(Integer, default=0)
+    games_played = Column(Integer, default=0)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    __table_args__ = (
+        Index('ix_leaderboard_points_desc', total_points.desc(), user_id),
+    )
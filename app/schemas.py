@@ -1,9 +1,13 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, ConfigDict, EmailStr
 from datetime import datetime
 from typing import Optional, List, Dict, Any
 
+# Валидаторы моделей строятся не при импорте, а в rebuild_schemas() на старте приложения
+
 # User Schemas
 class UserBase(BaseModel):
+    model_config = ConfigDict(defer_build=True)
+
     email: EmailStr
     phone: str
     telegram_id: str
@@ -15,6 +19,8 @@ class UserCreate(UserBase):
     password: str
 
 class UserLogin(BaseModel):
+    model_config = ConfigDict(defer_build=True)
+
     email: EmailStr
     password: str
 
@@ -26,11 +32,12 @@ class User(UserBase):
     total_points: Optional[int] = 0
     created_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Game Schemas
 class GameQuestionBase(BaseModel):
+    model_config = ConfigDict(defer_build=True)
+
     question_text: str
     question_type: str
     options: Optional[Dict[str, Any]] = None
@@ -45,10 +52,11 @@ class GameQuestion(GameQuestionBase):
     id: int
     game_id: int
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 class GameBase(BaseModel):
+    model_config = ConfigDict(defer_build=True)
+
     title: str
     description: str
     game_type: str
@@ -64,11 +72,12 @@ class Game(GameBase):
     created_at: datetime
     questions: List[GameQuestion] = []
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Reward Schemas
 class RewardBase(BaseModel):
+    model_config = ConfigDict(defer_build=True)
+
     name: str
     description: str
     points_required: int
@@ -83,11 +92,12 @@ class Reward(RewardBase):
     is_available: bool
     created_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Internship Schemas
 class InternshipBase(BaseModel):
+    model_config = ConfigDict(defer_build=True)
+
     title: str
     description: str
     requirements: str
@@ -102,11 +112,12 @@ class Internship(InternshipBase):
     is_active: bool
     created_at: datetime
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 # Response Schemas
 class LeaderboardUser(BaseModel):
+    model_config = ConfigDict(defer_build=True)
+
     rank: int
     user_id: int
     full_name: str
@@ -114,4 +125,17 @@ class LeaderboardUser(BaseModel):
     games_played: int
 
 class GameSubmission(BaseModel):
-    answers: Dict[str, str]  # question_id -> answer
\ No newline at end of file
+    model_config = ConfigDict(defer_build=True)
+
+    answers: Dict[str, str]  # question_id -> answer
+
+def rebuild_schemas():
+    """Собирает отложенные валидаторы всех схем заранее, до первого запроса"""
+    for model in (
+        UserBase, UserCreate, UserLogin, User,
+        GameQuestionBase, GameQuestionCreate, GameQuestion, GameBase, GameCreate, Game,
+        RewardBase, RewardCreate, Reward,
+        InternshipBase, InternshipCreate, Internship,
+        LeaderboardUser, GameSubmission
+    ):
+        model.model_rebuild()
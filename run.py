@@ -1,20 +1,35 @@
+import logging
+import os
 import uvicorn
-from app.database import create_database
+from app import models  # noqa: F401 - регистрирует таблицы в Base.metadata
+from app.database import init_database
 
 if __name__ == "__main__":
-    # Создаем базу данных при запуске
+    # Создаем базу данных один раз до запуска воркеров; startup каждого воркера
+    # затем видит готовую схему по отметке DB_INIT_SENTINEL
     print("🔄 Инициализация базы данных...")
-    create_database()
+    # Сообщения init_database идут через logging, а приложение (app.main) здесь еще не импортировано
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    init_database()
+
+    # Перезагрузка по изменению файлов только для разработки (DEV=1):
+    # с ней uvicorn работает в одном процессе и следит за файлами
+    reload = os.getenv("DEV") == "1"
+    options = {}
+    if not reload:
+        options["workers"] = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
 
     # Запускаем сервер
     print("🚀 Запуск сервера X5Tech Platform...")
     print("📊 Документация API: http://localhost:8000/docs")
     print("🌐 Веб-интерфейс: http://localhost:8000")
 
+    # loop/http="auto" выбирают uvloop и httptools, если они установлены (uvicorn[standard])
     uvicorn.run(
         "app.main:app",
         host="0.0.0.0",
         port=8000,
-        reload=True,
-        log_level="info"
-    )
\ No newline at end of file
+        reload=reload,
+        log_level="info",
+        **options
+    )